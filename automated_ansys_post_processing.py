@@ -5,7 +5,22 @@
 #Stadia42, Bradford Lynch, 2014, Chicago, IL
 
 ################################################################################
-import subprocess, csv, os
+import subprocess, csv, os, shutil, threading, time, Queue, hashlib, array
+import sys, socket, SocketServer, struct, json, signal, ntpath
+
+try:
+    import psutil
+except ImportError:
+    #Without psutil the scheduler cannot measure memory use and relies on its
+    #estimates and the memory budget alone
+    psutil = None
+
+#Default amount of local scratch space that staged results files may use
+DEFAULT_SCRATCH_BUDGET = 20 * 1024**3
+
+#Default time in seconds a CFD-Post worker may go without output before it is
+#considered hung
+DEFAULT_WORKER_TIMEOUT = 3600.
 
 ################################################################################
 
@@ -18,10 +33,990 @@ def runSessionOnResultsFile(sessionFileName, resultsFileName):
     Calls CFX post processor on resultsFileName using the session file given by
     sessionFileName
     '''
-    subprocess.call(['cfx5post', '-batch', sessionFileName, resultsFileName], shell=True)
+    startSessionOnResultsFile(sessionFileName, resultsFileName).wait()
 
     return
     
+def startSessionOnResultsFile(sessionFileName, resultsFileName, workingDir=None):
+    '''
+    Starts CFX post processor on resultsFileName using the session file given
+    by sessionFileName without waiting for it to finish. Returns the process.
+    '''
+    #Give CFD-Post its own process group so it can be killed with its children
+    if os.name == 'nt':
+        preexec_fn = None
+    else:
+        preexec_fn = os.setsid
+        
+    #cfx5post is a batch file on Windows, which needs the shell. Elsewhere a
+    #list of arguments with the shell would drop everything but the command.
+    return subprocess.Popen(['cfx5post', '-batch', sessionFileName, resultsFileName], shell=(os.name == 'nt'), cwd=workingDir, preexec_fn=preexec_fn)
+    
+def killProcessTree(process):
+    '''
+    Kills process and every process it started. On Windows CFD-Post is started
+    through the shell, and cfx5post starts further processes, so killing only
+    the process would leave CFD-Post running and holding its license.
+    '''
+    if psutil is not None:
+        try:
+            children = psutil.Process(process.pid).children(recursive=True)
+        except psutil.Error:
+            children = []
+            
+        for child in children:
+            try:
+                child.kill()
+            except psutil.Error:
+                pass
+                
+    elif os.name == 'nt':
+        subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+        
+    else:
+        try:
+            #Processes started in their own process group can be killed together
+            if os.getpgid(process.pid) == process.pid:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+            
+    try:
+        process.kill()
+    except OSError:
+        #Already exited
+        pass
+        
+def median(values):
+    '''
+    Returns the median of a non-empty list of numbers
+    '''
+    values = sorted(values)
+    middle = len(values)//2
+    
+    if len(values) % 2:
+        return values[middle]
+    else:
+        return (values[middle - 1] + values[middle])/2.
+        
+def moveFileAtomically(sourceFileName, destinationDir):
+    '''
+    Moves sourceFileName into destinationDir. The file is first copied next to
+    its destination under a temporary name and then renamed, so anything
+    reading destinationDir never sees a partially written file
+    '''
+    destinationFileName = os.path.join(destinationDir, os.path.basename(sourceFileName))
+    tempFileName = destinationFileName + '.part'
+    
+    shutil.copyfile(sourceFileName, tempFileName)
+    try:
+        os.rename(tempFileName, destinationFileName)
+    except OSError:
+        #os.rename does not replace an existing file on Windows
+        os.remove(destinationFileName)
+        os.rename(tempFileName, destinationFileName)
+        
+    os.remove(sourceFileName)
+    
+def publishDirectory(sourceDir, destinationDir):
+    '''
+    Moves every file in sourceDir into destinationDir using moveFileAtomically
+    and then removes sourceDir
+    '''
+    if not os.path.isdir(destinationDir):
+        os.makedirs(destinationDir)
+        
+    for fileName in os.listdir(sourceDir):
+        moveFileAtomically(os.path.join(sourceDir, fileName), destinationDir)
+        
+    os.rmdir(sourceDir)
+    
+class ResultsFileStager(object):
+    '''
+    Copies results files from network storage to a local scratch directory in
+    a background thread so that CFD-Post reads a local copy instead of the
+    share.
+    
+    'resultsFiles' is the list of results files in the order they will be
+    processed (None entries are skipped). Besides the files currently in use,
+    at most 'prefetchCount' files are staged ahead and the staged copies never
+    take more than 'diskBudget' bytes of scratch space. A results file larger
+    than the whole budget, or one that fails to copy, is read in place.
+    '''
+    def __init__(self, resultsFiles, scratchDir, prefetchCount=2, diskBudget=DEFAULT_SCRATCH_BUDGET):
+        self.resultsFiles = list(resultsFiles)
+        self.scratchDir = scratchDir
+        self.prefetchCount = prefetchCount
+        self.diskBudget = diskBudget
+        self.stagedFiles = {}
+        self.stagedSizes = {}
+        self.usedBytes = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+        
+    def start(self):
+        '''
+        Starts staging files in the background
+        '''
+        if not os.path.isdir(self.scratchDir):
+            os.makedirs(self.scratchDir)
+            
+        self.thread = threading.Thread(target=self.runStaging)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def stop(self):
+        '''
+        Stops staging and deletes any staged copies that were not released
+        '''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            
+        if self.thread is not None:
+            self.thread.join()
+            
+        for index in list(self.stagedSizes.keys()):
+            self.release(index)
+            
+    def runStaging(self):
+        '''
+        Runs stageFiles in the background thread. Whatever happens, the files
+        that were not staged are then read in place rather than waited for.
+        '''
+        try:
+            self.stageFiles()
+        finally:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+                
+    def stageFiles(self):
+        '''
+        Copies the results files to scratch in order. Runs in the background
+        thread started by start()
+        '''
+        for index in range(len(self.resultsFiles)):
+            sourceFileName = self.resultsFiles[index]
+            
+            if sourceFileName is None:
+                self.setStagedFile(index, None)
+                continue
+                
+            try:
+                size = os.path.getsize(sourceFileName)
+            except OSError, e:
+                print 'Unable to stage ' + sourceFileName + ', reading it in place (' + str(e) + ')'
+                self.setStagedFile(index, sourceFileName)
+                continue
+                
+            if size > self.diskBudget:
+                #Will never fit, so CFD-Post will have to read it in place
+                self.setStagedFile(index, sourceFileName)
+                continue
+                
+            with self.condition:
+                #Wait for a free slot in the prefetch window and in the budget
+                while not self.stopped and (len(self.stagedSizes) > self.prefetchCount or self.usedBytes + size > self.diskBudget):
+                    self.condition.wait()
+                    
+                if self.stopped:
+                    return
+                    
+                #Reserve the space before copying outside of the lock
+                self.stagedSizes[index] = size
+                self.usedBytes += size
+                
+            stagedFileName = os.path.join(self.scratchDir, str(index) + '_' + os.path.basename(sourceFileName))
+            try:
+                shutil.copyfile(sourceFileName, stagedFileName + '.part')
+                os.rename(stagedFileName + '.part', stagedFileName)
+            except (IOError, OSError), e:
+                print 'Unable to stage ' + sourceFileName + ', reading it in place (' + str(e) + ')'
+                with self.condition:
+                    del self.stagedSizes[index]
+                    self.usedBytes -= size
+                    
+                stagedFileName = sourceFileName
+                
+            self.setStagedFile(index, stagedFileName)
+            
+    def setStagedFile(self, index, fileName):
+        with self.condition:
+            self.stagedFiles[index] = fileName
+            self.condition.notify_all()
+            
+    def isStaged(self, index):
+        '''
+        Returns True if getStagedFile(index) would return without waiting
+        '''
+        with self.condition:
+            return index in self.stagedFiles or self.stopped
+            
+    def getStagedFile(self, index):
+        '''
+        Returns the file name to use for results file 'index', waiting for it to
+        finish staging if necessary
+        '''
+        with self.condition:
+            while index not in self.stagedFiles and not self.stopped:
+                self.condition.wait()
+                
+            return self.stagedFiles.get(index, self.resultsFiles[index])
+            
+    def release(self, index):
+        '''
+        Deletes the staged copy of results file 'index' once it has been
+        processed, freeing its space for the next files
+        '''
+        with self.condition:
+            if index not in self.stagedSizes:
+                return
+                
+            size = self.stagedSizes.pop(index)
+            stagedFileName = self.stagedFiles.get(index)
+            
+            if stagedFileName is not None:
+                for fileName in [stagedFileName, stagedFileName + '.part']:
+                    try:
+                        os.remove(fileName)
+                    except OSError:
+                        pass
+                        
+            self.usedBytes -= size
+            self.condition.notify_all()
+            
+class DesignPointWatcher(object):
+    '''
+    Watches the CFX directories of design points for a finished results file.
+    
+    'cfxDirs' maps each design point index to the directory its results files
+    are written to. Directories are only listed when their modification time
+    changes, so polling is cheap even on a network share. A results file counts
+    as finished once no run directory (*.dir) is left next to it and its size
+    and modification time did not change between two polls.
+    
+    Results files that already exist when the watcher is created are left
+    out unless 'includeExisting' is True, so that a design point solved again
+    in place is not reported with its old results before the solver starts.
+    '''
+    def __init__(self, cfxDirs, includeExisting=False):
+        self.cfxDirs = cfxDirs
+        self.pending = set(cfxDirs.keys())
+        self.dirMtimes = {}
+        self.candidates = {}
+        
+        #Results file -> modification time of the files to leave out
+        self.existingResults = {}
+        if not includeExisting:
+            for cfxDir in cfxDirs.values():
+                try:
+                    files = os.listdir(cfxDir)
+                except OSError:
+                    continue
+                    
+                for fileName in files:
+                    if fileName.split('.')[-1] == 'res':
+                        resultsFile = os.path.join(cfxDir, fileName)
+                        self.existingResults[resultsFile] = os.stat(resultsFile).st_mtime
+                        
+    def isExisting(self, resultsFile):
+        '''
+        Returns True if resultsFile is unchanged since the watcher was created
+        '''
+        if resultsFile not in self.existingResults:
+            return False
+            
+        try:
+            return os.stat(resultsFile).st_mtime == self.existingResults[resultsFile]
+        except OSError:
+            #Deleted for the new run
+            return True
+        
+    def findFinishedResultsFile(self, cfxDir):
+        '''
+        Returns the latest new results file in cfxDir, or None if there is none
+        or the solver is still running
+        '''
+        files = sorted(os.listdir(cfxDir))
+        if [fileName for fileName in files if fileName.split('.')[-1] == 'dir']:
+            return None
+            
+        files.reverse()  #We want the highest number
+        for fileName in files:
+            if fileName.split('.')[-1] == 'res':
+                resultsFile = os.path.join(cfxDir, fileName)
+                if not self.isExisting(resultsFile):
+                    return resultsFile
+                    
+        return None
+        
+    def poll(self):
+        '''
+        Returns a list of (dpIndex, resultsFile) for the design points that
+        finished since the last poll
+        '''
+        finished = []
+        
+        for dpIndex in sorted(self.pending):
+            cfxDir = self.cfxDirs[dpIndex]
+            try:
+                dirMtime = os.stat(cfxDir).st_mtime
+            except OSError:
+                #Workbench has not started this design point yet
+                continue
+                
+            if dirMtime != self.dirMtimes.get(dpIndex):
+                self.dirMtimes[dpIndex] = dirMtime
+                self.candidates[dpIndex] = None
+                
+                resultsFile = self.findFinishedResultsFile(cfxDir)
+                if resultsFile is not None:
+                    fileStat = os.stat(resultsFile)
+                    self.candidates[dpIndex] = (resultsFile, fileStat.st_size, fileStat.st_mtime)
+                    
+            elif self.candidates.get(dpIndex) is not None:
+                resultsFile, size, mtime = self.candidates[dpIndex]
+                try:
+                    fileStat = os.stat(resultsFile)
+                except OSError:
+                    self.candidates[dpIndex] = None
+                    continue
+                    
+                if (fileStat.st_size, fileStat.st_mtime) == (size, mtime):
+                    self.pending.remove(dpIndex)
+                    del self.candidates[dpIndex]
+                    finished.append((dpIndex, resultsFile))
+                else:
+                    #Still being written
+                    self.candidates[dpIndex] = (resultsFile, fileStat.st_size, fileStat.st_mtime)
+                    
+        return finished
+        
+class ResultsRepository(object):
+    '''
+    A store of post-processed results shared between sweeps, located in
+    'repositoryDir'. Each entry holds the output files (exports, hardcopies)
+    of one design point under its key, see CaseSweep.getDesignPointKey. The
+    outputs are stored by position, so they can be restored under the file
+    names of a design point of another sweep.
+    
+    The number of lookups that found an entry (hits) and that did not
+    (misses) are counted, see getHitRate.
+    '''
+    def __init__(self, repositoryDir):
+        self.repositoryDir = repositoryDir
+        self.hits = 0
+        self.misses = 0
+        
+    def getEntryDir(self, key):
+        return os.path.join(self.repositoryDir, key[:2], key)
+        
+    def getStoredFileName(self, entryDir, outputIndex, outputFile):
+        return os.path.join(entryDir, 'output' + str(outputIndex) + os.path.splitext(outputFile)[1])
+        
+    def lookup(self, key):
+        '''
+        Returns the directory of the entry for key, or None if there is none
+        '''
+        entryDir = self.getEntryDir(key)
+        
+        if os.path.isdir(entryDir):
+            self.hits += 1
+            return entryDir
+        else:
+            self.misses += 1
+            return None
+            
+    def getHitRate(self):
+        '''
+        Returns the fraction of lookups that found an entry
+        '''
+        if self.hits + self.misses == 0:
+            return 0.
+            
+        return self.hits/float(self.hits + self.misses)
+        
+    def store(self, key, outputFiles):
+        '''
+        Copies outputFiles into the entry for key. The entry is assembled under
+        a temporary name and then renamed, so a lookup never finds it partly
+        written. An existing entry is left alone.
+        '''
+        entryDir = self.getEntryDir(key)
+        if os.path.isdir(entryDir):
+            return
+            
+        tempDir = entryDir + '.' + str(os.getpid()) + '.tmp'
+        if not os.path.isdir(tempDir):
+            os.makedirs(tempDir)
+            
+        for outputIndex in range(len(outputFiles)):
+            shutil.copyfile(outputFiles[outputIndex], self.getStoredFileName(tempDir, outputIndex, outputFiles[outputIndex]))
+            
+        try:
+            os.rename(tempDir, entryDir)
+        except OSError:
+            #Stored by someone else in the meantime
+            shutil.rmtree(tempDir)
+            
+    def restore(self, key, outputFiles):
+        '''
+        Copies the stored outputs of key to outputFiles. Returns False if there
+        is no entry for key.
+        '''
+        entryDir = self.lookup(key)
+        if entryDir is None:
+            return False
+            
+        for outputIndex in range(len(outputFiles)):
+            outputDir = os.path.dirname(outputFiles[outputIndex])
+            if outputDir and not os.path.isdir(outputDir):
+                os.makedirs(outputDir)
+                
+            #Copy next to the destination and rename so readers never see a partial file
+            tempFileName = outputFiles[outputIndex] + '.part'
+            shutil.copyfile(self.getStoredFileName(entryDir, outputIndex, outputFiles[outputIndex]), tempFileName)
+            try:
+                os.rename(tempFileName, outputFiles[outputIndex])
+            except OSError:
+                #os.rename does not replace an existing file on Windows
+                os.remove(outputFiles[outputIndex])
+                os.rename(tempFileName, outputFiles[outputIndex])
+                
+        return True
+        
+    def remove(self, key):
+        '''
+        Removes the entry for key, e.g. when its outputs turned out to be bad.
+        The entry is renamed first so a lookup never finds it partly removed.
+        '''
+        entryDir = self.getEntryDir(key)
+        if not os.path.isdir(entryDir):
+            return
+            
+        tempDir = entryDir + '.' + str(os.getpid()) + '.del'
+        try:
+            os.rename(entryDir, tempDir)
+        except OSError:
+            #Removed by someone else in the meantime
+            return
+            
+        shutil.rmtree(tempDir)
+        
+################################################################################
+
+#Objects for scheduling CFD-Post runs
+
+################################################################################
+
+class PostProcessingJob(object):
+    '''
+    Defines a CFD-Post run of the session file 'sessionFileName' on the results
+    file 'resultsFileName' in the directory 'workingDir'.
+    
+    'prepare' is an optional function called right before the run is started
+    which returns the results file to actually open (e.g. a staged copy).
+    'isReady' is an optional function returning False while the job cannot
+    be started yet (e.g. its results file is still being staged), so that
+    prepare never has to wait. 'finish' is an optional function called with
+    the job once the run has ended. After the run, returnCode, peakRss (bytes), cpuTime and wallTime
+    (seconds) are set on the job; peakRss and cpuTime are None if they could
+    not be measured.
+    '''
+    def __init__(self, name, sessionFileName, resultsFileName, workingDir=None, prepare=None, finish=None, isReady=None):
+        self.name = name
+        self.sessionFileName = sessionFileName
+        self.resultsFileName = resultsFileName
+        self.workingDir = workingDir
+        self.prepare = prepare
+        self.finish = finish
+        self.isReady = isReady
+        self.resultsSize = os.path.getsize(resultsFileName)
+        self.estimatedMemory = None
+        self.process = None
+        self.startTime = None
+        self.returnCode = None
+        self.peakRss = None
+        self.cpuTime = None
+        self.wallTime = None
+        self.processCpuTimes = {}
+        
+class PostProcessingScheduler(object):
+    '''
+    Runs PostProcessingJobs concurrently without exhausting memory.
+    
+    The peak RSS and CPU time of every job is recorded (in 'historyFile' too,
+    if given, so that it carries over between sweeps). The memory a new job
+    needs is estimated from the size of its results file by a fixed amount
+    plus an amount per byte fitted to that history (see estimateMemory). Jobs are started in the
+    order they were submitted, and only while fewer than 'maxConcurrent' are
+    running (e.g. the number of CFD-Post licenses) and the estimate fits in
+    the free memory. Free memory is what the system reports as available
+    (requires psutil) less what running jobs are still expected to claim,
+    capped by 'memoryBudget' bytes if given. A job is always started when
+    nothing else is running. A job whose isReady function returns False
+    holds back the jobs after it until it is ready. A job whose prepare or
+    finish function fails is reported and the other jobs carry on.
+    '''
+    historyHeaders = ['Name', 'Results Size', 'Peak RSS', 'CPU Time', 'Wall Time']
+    
+    def __init__(self, maxConcurrent=1, memoryBudget=None, historyFile=None, safetyFactor=1.2, defaultMemoryRatio=3.0, pollInterval=1.0):
+        self.maxConcurrent = maxConcurrent
+        self.memoryBudget = memoryBudget
+        self.historyFile = historyFile
+        self.safetyFactor = safetyFactor
+        self.defaultMemoryRatio = defaultMemoryRatio
+        self.pollInterval = pollInterval
+        self.pending = []
+        self.running = []
+        self.history = []
+        
+        if historyFile is not None and os.path.exists(historyFile):
+            self.readHistoryFile()
+            
+    def readHistoryFile(self):
+        '''
+        Reads the records of previous jobs from the history file
+        '''
+        with open(self.historyFile, 'rb') as csvFile:
+            historyData = csv.reader(csvFile, delimiter=',')
+            historyData.next()  #Skip the header row
+            
+            for row in historyData:
+                record = {}
+                for header, cell in zip(self.historyHeaders, row):
+                    try:
+                        cell = float(cell)
+                    except ValueError:
+                        #Name or a quantity that was not measured
+                        if header != 'Name':
+                            cell = None
+                            
+                    record[header] = cell
+                    
+                self.history.append(record)
+                
+    def recordJob(self, job):
+        '''
+        Adds the measurements of a finished job to the history
+        '''
+        record = {'Name': job.name,
+                  'Results Size': job.resultsSize,
+                  'Peak RSS': job.peakRss,
+                  'CPU Time': job.cpuTime,
+                  'Wall Time': job.wallTime}
+        self.history.append(record)
+        
+        if self.historyFile is not None:
+            newFile = not os.path.exists(self.historyFile)
+            with open(self.historyFile, 'ab') as csvFile:
+                historyWriter = csv.writer(csvFile, delimiter=',')
+                if newFile:
+                    historyWriter.writerow(self.historyHeaders)
+                    
+                historyWriter.writerow(['' if record[header] is None else record[header] for header in self.historyHeaders])
+                
+    def estimateMemory(self, resultsSize):
+        '''
+        Returns the estimated peak memory in bytes of a job on a results file of
+        resultsSize bytes. CFD-Post needs a fixed amount of memory plus an
+        amount that grows with the results file, so a line is fitted to the
+        history by least squares and raised until no recorded job lies above
+        it. With fewer than two different results file sizes in the history,
+        'defaultMemoryRatio' is used as the slope.
+        '''
+        records = [(record['Results Size'], record['Peak RSS']) for record in self.history if record['Peak RSS'] and record['Results Size']]
+        
+        if not records:
+            return int(self.defaultMemoryRatio*resultsSize*self.safetyFactor)
+            
+        sizes = [size for size, peakRss in records]
+        meanSize = sum(sizes)/float(len(sizes))
+        meanPeakRss = sum([peakRss for size, peakRss in records])/float(len(records))
+        sizeVariance = sum([(size - meanSize)**2 for size in sizes])
+        
+        if sizeVariance > 0:
+            slope = sum([(size - meanSize)*(peakRss - meanPeakRss) for size, peakRss in records])/sizeVariance
+            #Memory never shrinks with larger results files
+            slope = max(slope, 0.)
+        else:
+            slope = self.defaultMemoryRatio
+            
+        intercept = max([peakRss - slope*size for size, peakRss in records] + [0.])
+        
+        return int((intercept + slope*resultsSize)*self.safetyFactor)
+        
+    def getFreeMemory(self):
+        '''
+        Returns the memory in bytes available to a new job, or None if unlimited
+        '''
+        freeMemory = None
+        
+        if psutil is not None:
+            #Running jobs may still grow up to their estimate
+            stillToClaim = sum([max(job.estimatedMemory - (job.peakRss or 0), 0) for job in self.running])
+            freeMemory = psutil.virtual_memory().available - stillToClaim
+            
+        if self.memoryBudget is not None:
+            inUse = sum([max(job.estimatedMemory, job.peakRss or 0) for job in self.running])
+            if freeMemory is None:
+                freeMemory = self.memoryBudget - inUse
+            else:
+                freeMemory = min(freeMemory, self.memoryBudget - inUse)
+                
+        return freeMemory
+        
+    def submit(self, job):
+        '''
+        Queues job to be run
+        '''
+        job.estimatedMemory = self.estimateMemory(job.resultsSize)
+        self.pending.append(job)
+        
+    def startJob(self, job):
+        job.startTime = time.time()
+        try:
+            if job.prepare is not None:
+                resultsFileName = job.prepare()
+            else:
+                resultsFileName = job.resultsFileName
+                
+            job.startTime = time.time()
+            job.process = startSessionOnResultsFile(job.sessionFileName, resultsFileName, job.workingDir)
+        except Exception, e:
+            #Keep the other jobs going
+            print 'Unable to start ' + job.name + ' (' + str(e) + ')'
+            job.returnCode = 1
+            job.wallTime = time.time() - job.startTime
+            
+            if job.finish is not None:
+                try:
+                    job.finish(job)
+                except Exception, e:
+                    print 'Unable to finish ' + job.name + ' (' + str(e) + ')'
+                    
+            return
+            
+        self.running.append(job)
+        
+    def measureJob(self, job):
+        '''
+        Updates the peak RSS and CPU time of a running job from its process tree
+        '''
+        if psutil is None:
+            return
+            
+        try:
+            parent = psutil.Process(job.process.pid)
+            processes = [parent] + parent.children(recursive=True)
+        except psutil.Error:
+            #The job has already exited
+            return
+            
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+                cpuTimes = process.cpu_times()
+                job.processCpuTimes[process.pid] = cpuTimes.user + cpuTimes.system
+            except psutil.Error:
+                pass
+                
+        job.peakRss = max(job.peakRss or 0, rss)
+        job.cpuTime = sum(job.processCpuTimes.values())
+        
+    def finishJob(self, job):
+        job.wallTime = time.time() - job.startTime
+        self.running.remove(job)
+        self.recordJob(job)
+        
+        if job.returnCode != 0:
+            print 'CFD-Post exited with code ' + str(job.returnCode) + ' on ' + job.name
+            
+        if job.finish is not None:
+            try:
+                job.finish(job)
+            except Exception, e:
+                print 'Unable to finish ' + job.name + ' (' + str(e) + ')'
+                
+    def step(self):
+        '''
+        Checks on the running jobs and starts as many pending jobs as the limits
+        allow. Returns True while there are jobs pending or running.
+        '''
+        for job in list(self.running):
+            self.measureJob(job)
+            
+            #Reaping the process adds its CPU time to that of our children
+            childTimesBefore = os.times()
+            job.returnCode = job.process.poll()
+            if job.returnCode is not None:
+                #Windows does not report the CPU time of children
+                if psutil is None and os.name != 'nt':
+                    childTimesAfter = os.times()
+                    job.cpuTime = (childTimesAfter[2] - childTimesBefore[2]) + (childTimesAfter[3] - childTimesBefore[3])
+                    
+                self.finishJob(job)
+                
+        while self.pending and len(self.running) < self.maxConcurrent:
+            freeMemory = self.getFreeMemory()
+            job = self.pending[0]
+            if self.running and freeMemory is not None and job.estimatedMemory > freeMemory:
+                break
+                
+            #Waiting here would stop running jobs from being finished and
+            #releasing what this one waits for, so check again on the next step
+            if job.isReady is not None and not job.isReady():
+                break
+                
+            self.startJob(self.pending.pop(0))
+            
+        return bool(self.pending or self.running)
+        
+    def run(self):
+        '''
+        Runs all submitted jobs and waits for them to finish
+        '''
+        try:
+            while self.step():
+                time.sleep(self.pollInterval)
+        finally:
+            self.stop()
+            
+    def stop(self):
+        '''
+        Kills the running jobs, e.g. when processing was interrupted, so they
+        do not keep their licenses and results files
+        '''
+        for job in self.running:
+            print 'Stopping ' + job.name
+            killProcessTree(job.process)
+            
+        self.running = []
+        
+class CFDPostWorker(object):
+    '''
+    Keeps a CFD-Post process running in line mode and plays session files in
+    it through its command pipe, so that startup and licensing are paid for
+    once instead of per design point.
+    
+    Each session file played loads the next results file (see Load) and then
+    issues the sections of the design point. If CFD-Post crashes, stops
+    responding for 'timeout' seconds (None waits forever) or closes its pipe,
+    the worker is restarted and the session file played again, up to
+    'maxRestarts' times.
+    '''
+    def __init__(self, workingDir=None, timeout=DEFAULT_WORKER_TIMEOUT, maxRestarts=1):
+        self.workingDir = workingDir
+        self.timeout = timeout
+        self.maxRestarts = maxRestarts
+        self.process = None
+        self.output = None
+        self.numCommands = 0
+        self.lastLines = []
+        
+    def isAlive(self):
+        return self.process is not None and self.process.poll() is None
+        
+    def start(self):
+        '''
+        Starts CFD-Post
+        '''
+        #Give CFD-Post its own process group so it can be killed with its children
+        if os.name == 'nt':
+            preexec_fn = None
+        else:
+            preexec_fn = os.setsid
+            
+        #cfx5post is a batch file on Windows, which needs the shell
+        self.process = subprocess.Popen(['cfx5post', '-line'], shell=(os.name == 'nt'), cwd=self.workingDir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=preexec_fn)
+        
+        #Read the output in the background so a hung or dead CFD-Post can be detected
+        self.output = Queue.Queue()
+        self.lastLines = []
+        reader = threading.Thread(target=self.readOutput, args=(self.process.stdout, self.output))
+        reader.daemon = True
+        reader.start()
+        
+    def stop(self):
+        '''
+        Asks CFD-Post to quit, killing it if it does not
+        '''
+        if self.isAlive():
+            try:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.close()
+            except IOError:
+                pass
+                
+            for i in range(50):
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                killProcessTree(self.process)
+                
+        self.process = None
+        
+    def readOutput(self, stream, output):
+        for line in iter(stream.readline, ''):
+            output.put(line)
+            
+        #End of file, CFD-Post has exited
+        output.put(None)
+        
+    def playSessionFile(self, sessionFileName):
+        '''
+        Plays sessionFileName in the running CFD-Post process and waits for it
+        to finish. Raises RuntimeError if CFD-Post dies or times out.
+        '''
+        self.numCommands += 1
+        doneMarker = 'CFD-Post worker done ' + str(self.numCommands)
+        
+        try:
+            self.process.stdin.write('>readsession filename=' + sessionFileName + '\n')
+            #Perl lines are run by CFD-Post once the session has been played
+            self.process.stdin.write('!print "' + doneMarker + '\\n";\n')
+            self.process.stdin.flush()
+        except IOError, e:
+            raise RuntimeError('Lost the command pipe to CFD-Post (' + str(e) + ')')
+            
+        while True:
+            try:
+                line = self.output.get(timeout=self.timeout)
+            except Queue.Empty:
+                killProcessTree(self.process)
+                raise RuntimeError('CFD-Post did not respond within ' + str(self.timeout) + ' s')
+                
+            if line is None:
+                raise RuntimeError('CFD-Post exited unexpectedly. Last output:\n' + ''.join(self.lastLines))
+                
+            if line.strip() == doneMarker:
+                return
+                
+            self.lastLines = (self.lastLines + [line])[-20:]
+            
+    def runSessionFile(self, sessionFileName):
+        '''
+        Plays sessionFileName, starting CFD-Post if needed and restarting it if
+        it crashes
+        '''
+        for attempt in range(self.maxRestarts + 1):
+            try:
+                if not self.isAlive():
+                    self.start()
+                    
+                self.playSessionFile(sessionFileName)
+                return
+                
+            except RuntimeError, e:
+                print 'CFD-Post worker failed on ' + sessionFileName + ' (' + str(e) + ')'
+                self.stop()
+                error = e
+                
+        raise error
+        
+class CFDPostWorkerPool(object):
+    '''
+    A pool of 'numWorkers' CFDPostWorkers, each fed by its own thread.
+    submit() queues a PostProcessingJob and returns at once; wait() blocks
+    until every submitted job has finished and run() does both. The session
+    file of each job must load its results file itself (see Load). A job that
+    fails still has its finish function called. Call close() when done to stop
+    the CFD-Post processes.
+    '''
+    def __init__(self, numWorkers=1, workingDir=None, timeout=DEFAULT_WORKER_TIMEOUT, maxRestarts=1):
+        self.workers = [CFDPostWorker(workingDir, timeout, maxRestarts) for i in range(numWorkers)]
+        self.jobQueue = Queue.Queue()
+        self.numPending = 0
+        self.condition = threading.Condition()
+        
+        self.threads = []
+        for worker in self.workers:
+            thread = threading.Thread(target=self.runJobs, args=(worker,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            
+    def submit(self, job):
+        '''
+        Queues a job for the next free worker
+        '''
+        with self.condition:
+            self.numPending += 1
+            
+        self.jobQueue.put(job)
+        
+    def isBusy(self):
+        '''
+        Returns True while submitted jobs have not finished
+        '''
+        with self.condition:
+            return self.numPending > 0
+            
+    def wait(self):
+        '''
+        Waits for all submitted jobs to finish
+        '''
+        with self.condition:
+            while self.numPending > 0:
+                #Wait with a timeout so KeyboardInterrupt gets through
+                self.condition.wait(1.)
+                
+    def run(self, jobs):
+        '''
+        Runs the jobs on the workers and waits for them to finish
+        '''
+        for job in jobs:
+            self.submit(job)
+            
+        self.wait()
+        
+    def runJobs(self, worker):
+        while True:
+            job = self.jobQueue.get()
+            if job is None:
+                return
+                
+            job.startTime = time.time()
+            try:
+                if job.prepare is not None:
+                    job.prepare()
+                    
+                worker.runSessionFile(job.sessionFileName)
+                job.returnCode = 0
+            except Exception, e:
+                #Keep the worker going for the other jobs
+                print 'CFD-Post worker failed on ' + job.name + ' (' + str(e) + ')'
+                job.returnCode = 1
+                
+            job.wallTime = time.time() - job.startTime
+            
+            if job.finish is not None:
+                try:
+                    job.finish(job)
+                except Exception, e:
+                    print 'Unable to finish ' + job.name + ' (' + str(e) + ')'
+                    
+            with self.condition:
+                self.numPending -= 1
+                self.condition.notifyAll()
+                
+    def close(self):
+        '''
+        Lets the workers finish the queued jobs, then stops them
+        '''
+        for thread in self.threads:
+            self.jobQueue.put(None)
+            
+        for thread in self.threads:
+            thread.join()
+            
+        for worker in self.workers:
+            worker.stop()
+            
 ################################################################################
 
 #Objects for defining cases of CFD runs
@@ -34,13 +1029,21 @@ class CaseSweep(object):
     be a CSV file with a table of the cases that were run; this can be copied 
     directly from Ansys Workbench
     '''
+    #Names of the columns that are inputs to the CFD runs, the other columns
+    #hold outputs of the runs. Set by derived classes.
+    inputParameterNames = None
+    
     def __init__(self, sweepDefinitionFile, rootDirectory, modelName):
         self.sweepFile = sweepDefinitionFile
         self.rootDir = rootDirectory
         self.modelName = modelName
         self.sweepHeaders = {}
         self.sweepDict = {}
+        self.sweepUnits = {}
         self.sweepCaseResults = {}
+        self.sweepMetrics = None
+        self.metrics = []
+        self.localResultsDirs = {}
 
         #Read sweep definition file
         self.readSweepDefFile()
@@ -53,6 +1056,7 @@ class CaseSweep(object):
         
         sweepHeaders contains the Column Index -> Column Name
         sweepDict contains the Column Name -> List of Values
+        sweepUnits contains the Column Name -> Units
         '''
         i = 0
         with open(self.sweepFile, 'rb') as csvFile:
@@ -68,8 +1072,12 @@ class CaseSweep(object):
                         col += 1
 
                 elif i == 1:
-                    #This is the units row. Do nothing for now
-                    pass
+                    #This is the units row. Keep it for writing sweep definition files
+                    col = 0
+                    for cell in row:
+                        self.sweepUnits[self.sweepHeaders[col]] = cell
+                        col += 1
+                        
                 else:
                     col = 0
                     for cell in row:
@@ -86,74 +1094,596 @@ class CaseSweep(object):
                         
                 i += 1
                 
-    def writeSessionFile(self, sessionFileName, designPointIndex):
+    def addMetric(self, name, definition):
+        '''
+        Adds a scalar metric evaluated by CFD-Post for every design point, such
+        as addMetric('gapMassFlow', 'massFlow()@gap'). 'definition' is a CFD-Post
+        (CEL) expression. Derived classes add the expressions to their session
+        sections and a MetricsExport of them, see FlapperDesignSweep.
+        '''
+        self.metrics.append(Expression(name, definition))
+        
+    def writeSweepDefFile(self, sweepDefinitionFile, designPointColumnName, newDesignPoints, includeExisting=True):
+        '''
+        Writes a sweep definition file in the same format as the one read by
+        readSweepDefFile, with the design points of this sweep (unless
+        includeExisting is False) followed by 'newDesignPoints'. Each new
+        design point is a dictionary of Column Name -> Value. New design points
+        are numbered after the existing ones. They must set every input
+        parameter (see getInputParameterNames); the output columns are left
+        blank for Workbench to fill in.
+        '''
+        headers = [self.sweepHeaders[col] for col in sorted(self.sweepHeaders.keys())]
+        
+        #A design point without all its inputs cannot be solved
+        inputParameterNames = self.getInputParameterNames()
+        for newDesignPoint in newDesignPoints:
+            missingNames = [name for name in inputParameterNames if name not in newDesignPoint]
+            if missingNames:
+                raise ValueError('New design point ' + str(newDesignPoint) + ' does not set the input parameters ' + ', '.join(missingNames))
+                
+        dpNumbers = [0]
+        for designPoint in self.sweepDict[designPointColumnName]:
+            if designPoint != 'Current':
+                dpNumbers.append(int(designPoint.split()[-1]))
+                
+        with open(sweepDefinitionFile, 'wb') as csvFile:
+            sweepWriter = csv.writer(csvFile, delimiter=',')
+            sweepWriter.writerow(headers)
+            sweepWriter.writerow([self.sweepUnits.get(header, '') for header in headers])
+            
+            if includeExisting:
+                for dpIndex in range(len(self.sweepDict[designPointColumnName])):
+                    sweepWriter.writerow([repr(self.sweepDict[header][dpIndex]) if type(self.sweepDict[header][dpIndex]) == float else self.sweepDict[header][dpIndex] for header in headers])
+                    
+            for newDesignPoint in newDesignPoints:
+                dpNumbers.append(max(dpNumbers) + 1)
+                
+                row = []
+                for header in headers:
+                    if header == designPointColumnName:
+                        value = 'DP ' + str(dpNumbers[-1])
+                    elif header in newDesignPoint:
+                        value = newDesignPoint[header]
+                    else:
+                        value = ''
+                        
+                    row.append(repr(value) if type(value) == float else value)
+                    
+                sweepWriter.writerow(row)
+                
+    def getSharedSessionSections(self):
         '''
-        Method to write out a CFD-Post session file. In the base class this is
-        not implemented because it is highly dependent on the CFD cases that
-        were run.
+        Returns the session sections that are the same for every design point,
+        such as views. By default there are none.
+        '''
+        return []
+        
+    def getDesignPointSessionSections(self, designPointIndex):
+        '''
+        Returns the session sections that produce the results of a design
+        point. In the base class this is not implemented because it is highly
+        dependent on the CFD cases that were run.
         '''
         
         raise NotImplementedError
         
-    def processResults(self, designPointColumnName):
+    def writeSessionFile(self, sessionFileName, designPointIndex):
         '''
-        Steps through list of cases and runs the session file on the case results
+        Method to write out a CFD-Post session file made of the shared session
+        sections followed by the sections of the design point. Derived classes
+        either implement getDesignPointSessionSections or override this method.
         '''
-        #Step through design points
-        for dpIndex in range(len(self.sweepDict[designPointColumnName])):
-            designPoint = self.sweepDict[designPointColumnName][dpIndex]
-            #Determine the working directory
-            if designPoint == 'Current':
-                designPoint = 'dp0'
-                dpDir = self.rootDir + '\\' + self.modelName + '_files'
+        session = SessionFile(self.getSharedSessionSections() + self.getDesignPointSessionSections(designPointIndex))
+        session.writeSessionFile(sessionFileName)
+        
+    def getDesignPointOutputs(self, dpIndex):
+        '''
+        Returns the list of files the session sections of design point dpIndex
+        write, such as exports and hardcopies
+        '''
+        outputFiles = []
+        for section in self.getDesignPointSessionSections(dpIndex):
+            if hasattr(section, 'getOutputFiles'):
+                outputFiles.extend(section.getOutputFiles())
                 
+        return outputFiles
+        
+    def getDesignPointKey(self, designPointColumnName, dpIndex, parameterNames=None):
+        '''
+        Returns the key of design point dpIndex in a ResultsRepository. It is a
+        hash of the parameters of the design point and of its session
+        definition, with the output file names taken out so that design points
+        with the same parameters in different sweeps share a key.
+        
+        The parameters are 'parameterNames', by default the input parameters
+        (see getInputParameterNames), so that output parameters filled in by
+        Workbench do not change the key.
+        '''
+        if parameterNames is None:
+            parameterNames = self.getInputParameterNames()
+            
+        keyLines = []
+        for key in sorted(parameterNames):
+            value = self.sweepDict[key][dpIndex]
+            if type(value) == float:
+                #Ignore round off in the sweep definition files
+                value = '%.10g' % value
+                
+            keyLines.append(key + ' = ' + str(value))
+            
+        outputFiles = self.getDesignPointOutputs(dpIndex)
+        session = SessionFile(self.getSharedSessionSections() + self.getDesignPointSessionSections(dpIndex))
+        for line in session.getDefinition():
+            for outputIndex in range(len(outputFiles)):
+                #Sections write the paths with either kind of slash
+                line = line.replace(outputFiles[outputIndex], '<Output ' + str(outputIndex) + '>')
+                line = line.replace(outputFiles[outputIndex].replace('\\', '/'), '<Output ' + str(outputIndex) + '>')
+                
+            keyLines.append(line)
+            
+        return hashlib.sha1('\n'.join(keyLines)).hexdigest()
+        
+    def getResultsDir(self, dpIndex):
+        '''
+        Returns the directory the session file of design point dpIndex should
+        save its exports and hardcopies to
+        '''
+        return self.localResultsDirs.get(dpIndex, self.rootDir + '\\sweepResults')
+        
+    def findDesignPointDir(self, designPointColumnName, dpIndex):
+        '''
+        Returns the design point name and the CFX results directory of design
+        point dpIndex
+        '''
+        designPoint = self.sweepDict[designPointColumnName][dpIndex]
+        #Determine the working directory
+        if designPoint == 'Current':
+            designPoint = 'dp0'
+            dpDir = self.rootDir + '\\' + self.modelName + '_files'
+            
+        else:
+            designPoint = designPoint.replace(' ', '').lower()
+            dpDir = self.rootDir + '\\' + self.modelName + '_' + designPoint + '_files'
+            
+        return designPoint, dpDir + '\\' + designPoint + '\\CFX-1\\CFX'
+        
+    def findResultsFile(self, designPointColumnName, dpIndex):
+        '''
+        Returns the design point name, the CFX results directory and the path of
+        the latest results file of design point dpIndex. The results file is
+        None if the design point has no results yet.
+        '''
+        designPoint, cfxDir = self.findDesignPointDir(designPointColumnName, dpIndex)
+        
+        #Determine the latest results file
+        files = os.listdir(cfxDir)
+        files.reverse()  #Reversing the order because the files are listed lowest number to highest number and we want the highest number
+        for fileName in files:
+            if fileName.split('.')[-1] == 'res':
+                #Exit after finding the latest file
+                return designPoint, cfxDir, cfxDir + '\\' + fileName
+                
+        return designPoint, cfxDir, None
+        
+    def createPostProcessingJob(self, dpIndex, designPoint, cfxDir, resultsFile, stager=None, scratchDir=None, persistent=False, repository=None, repositoryKey=None):
+        '''
+        Returns a PostProcessingJob that writes the session file of design
+        point dpIndex and runs it on resultsFile. With a stager, the staged copy
+        of the results file is used and the exports are written to scratchDir
+        before being moved into the results directory. If 'persistent' is
+        True, the session file is written for a CFDPostWorker: it loads the
+        results file and then plays the shared sections again, since loading
+        a case can reset views, followed by the sections of the design point. With
+        a repository, the outputs of a successful run are stored under
+        repositoryKey.
+        '''
+        resultsDir = self.getResultsDir(dpIndex)
+        sessionFileName = cfxDir + '\\Post' + str(designPoint) + '.cse'
+        
+        def prepare():
+            localResultsFile = resultsFile
+            if stager is not None:
+                localResultsFile = stager.getStagedFile(dpIndex)
+                self.localResultsDirs[dpIndex] = os.path.join(scratchDir, 'exports_dp' + str(dpIndex))
+                if not os.path.isdir(self.localResultsDirs[dpIndex]):
+                    os.makedirs(self.localResultsDirs[dpIndex])
+                    
+            #Write a session file
+            if persistent:
+                session = SessionFile([Load(localResultsFile)] + self.getSharedSessionSections() + self.getDesignPointSessionSections(dpIndex))
+                session.writeSessionFile(sessionFileName)
             else:
-                designPoint = designPoint.replace(' ', '').lower()
-                dpDir = self.rootDir + '\\' + self.modelName + '_' + designPoint + '_files'
+                self.writeSessionFile(sessionFileName, dpIndex)
                 
-            #Change to the design point directory, then to the results directory
-            os.chdir(dpDir)
-            os.chdir(designPoint + '\\CFX-1\\CFX')
+            print 'Processing Design Point ' + str(dpIndex)
+            return localResultsFile
             
-            #Determine the latest results file
-            files = os.listdir('.')
-            files.reverse()  #Reversing the order because the files are listed lowest number to highest number and we want the highest number
-            for fileName in files:
-                if fileName.split('.')[-1] == 'res':
-                    resultsFile = fileName
+        def finish(job):
+            if stager is not None:
+                stager.release(dpIndex)
+                
+                #Nothing to publish if the job failed before it was prepared
+                localResultsDir = self.localResultsDirs.pop(dpIndex, None)
+                if localResultsDir is not None:
+                    if job.returnCode == 0:
+                        publishDirectory(localResultsDir, resultsDir)
+                    else:
+                        #Partial outputs of a failed run must not replace good ones
+                        shutil.rmtree(localResultsDir, ignore_errors=True)
+                        
+            if repository is not None and job.returnCode == 0:
+                outputFiles = self.getDesignPointOutputs(dpIndex)
+                if not [fileName for fileName in outputFiles if not os.path.exists(fileName)]:
+                    repository.store(repositoryKey, outputFiles)
                     
-                    #Exit loop after finding the latest file
-                    break
+        def isReady():
+            return stager is None or stager.isStaged(dpIndex)
+            
+        return PostProcessingJob('Design Point ' + str(dpIndex), sessionFileName, resultsFile, cfxDir, prepare, finish, isReady)
+        
+    def createWorkerPool(self, numWorkers=1, timeout=DEFAULT_WORKER_TIMEOUT):
+        '''
+        Returns a CFDPostWorkerPool working in the root directory of this
+        sweep, for use with processResults
+        '''
+        return CFDPostWorkerPool(numWorkers, self.rootDir, timeout)
+        
+    def processResults(self, designPointColumnName, scratchDir=None, prefetchCount=2, scratchBudget=DEFAULT_SCRATCH_BUDGET, scheduler=None, pool=None, designPointIndices=None, repository=None, parameterNames=None, reuse=True):
+        '''
+        Steps through list of cases and runs the session file on the case results
+        
+        Only the design points in 'designPointIndices' are processed if given,
+        e.g. those flagged by validateResults.
+        
+        With a ResultsRepository, design points whose key (see
+        getDesignPointKey, which takes 'parameterNames') is already in the
+        repository get their outputs copied from it instead of running
+        CFD-Post, and the outputs of the others are added to it. With
+        'reuse=False' the repository entries of the design points are removed
+        instead and replaced by the outputs of the new runs, e.g. to process
+        the design points flagged by validateResults again.
+        
+        The CFD-Post runs are started by 'scheduler', a PostProcessingScheduler,
+        which by default processes one design point at a time. Alternatively the
+        design points are processed by the persistent CFD-Post workers of
+        'pool' (see createWorkerPool), which requires the sweep to implement
+        getDesignPointSessionSections.
+        
+        If 'scratchDir' is given, the results files of the next 'prefetchCount'
+        design points are copied to local scratch while the current ones are
+        processed (see ResultsFileStager), and the exports and hardcopies are
+        written to scratch and then moved into 'sweepResults'
+        '''
+        if scheduler is None:
+            scheduler = PostProcessingScheduler()
+            
+        if designPointIndices is None:
+            designPointIndices = range(len(self.sweepDict[designPointColumnName]))
+            
+        #Reuse the results of design points processed before
+        if repository is not None:
+            repositoryKeys = {}
+            for dpIndex in list(designPointIndices):
+                repositoryKeys[dpIndex] = self.getDesignPointKey(designPointColumnName, dpIndex, parameterNames)
+                if not reuse:
+                    #Drop outputs that are being replaced
+                    repository.remove(repositoryKeys[dpIndex])
+                elif repository.restore(repositoryKeys[dpIndex], self.getDesignPointOutputs(dpIndex)):
+                    print 'Reusing results for Design Point ' + str(dpIndex)
+                    designPointIndices = [index for index in designPointIndices if index != dpIndex]
                     
-            #Write a session file
-            sessionFileName = 'Post' + str(designPoint) + '.cse'
-            self.writeSessionFile(sessionFileName, dpIndex)
+        #Results files are staged in order of design point
+        designPointIndices = sorted(designPointIndices)
+        caseFiles = [self.findResultsFile(designPointColumnName, dpIndex) for dpIndex in designPointIndices]
+        
+        stager = None
+        if scratchDir is not None:
+            #Keep the paths valid whatever the working directory
+            scratchDir = os.path.abspath(scratchDir)
             
-            #Call CFD-Post on the results file
-            print 'Processing Design Point ' + str(dpIndex)
-            runSessionOnResultsFile(sessionFileName, resultsFile)
+            #Files of the running design points count against the prefetch window
+            if pool is not None:
+                stagerPrefetchCount = prefetchCount + len(pool.workers) - 1
+            else:
+                stagerPrefetchCount = prefetchCount + scheduler.maxConcurrent - 1
+                
+            #The stager is indexed by design point, skipping those not processed
+            stagedFiles = [None]*len(self.sweepDict[designPointColumnName])
+            for i in range(len(designPointIndices)):
+                stagedFiles[designPointIndices[i]] = caseFiles[i][2]
+                
+            stager = ResultsFileStager(stagedFiles, scratchDir, stagerPrefetchCount, scratchBudget)
+            stager.start()
             
-            #Return to the root directory
-            os.chdir(self.rootDir)
+        try:
+            #Step through design points
+            jobs = []
+            for i in range(len(designPointIndices)):
+                dpIndex = designPointIndices[i]
+                designPoint, cfxDir, resultsFile = caseFiles[i]
+                if resultsFile is None:
+                    print 'No results file found for Design Point ' + str(dpIndex)
+                    continue
+                    
+                if repository is not None:
+                    jobs.append(self.createPostProcessingJob(dpIndex, designPoint, cfxDir, resultsFile, stager, scratchDir, pool is not None, repository, repositoryKeys[dpIndex]))
+                else:
+                    jobs.append(self.createPostProcessingJob(dpIndex, designPoint, cfxDir, resultsFile, stager, scratchDir, pool is not None))
+                
+            if pool is not None:
+                pool.run(jobs)
+            else:
+                for job in jobs:
+                    scheduler.submit(job)
+                    
+                scheduler.run()
             
-            #Read results file
+        finally:
+            if stager is not None:
+                stager.stop()
+                
+    def watchResults(self, designPointColumnName, pollInterval=30., scheduler=None, pool=None, idleTimeout=12*3600., includeExisting=False):
+        '''
+        Post-processes each design point as soon as Workbench has finished
+        solving it, instead of waiting for the whole sweep (see
+        DesignPointWatcher). The rootDir is checked every 'pollInterval'
+        seconds. Finished design points are run by 'scheduler' or, if given, by
+        the persistent workers of 'pool' as in processResults.
+        
+        Results files that exist before watching starts are only processed
+        if 'includeExisting' is True; by default they are taken to be stale
+        results of design points that are being solved again.
+        
+        Returns once every design point has been processed, or once no design
+        point has finished for 'idleTimeout' seconds (e.g. because one failed
+        to solve). Returns the list of design points that never finished.
+        '''
+        if scheduler is None:
+            scheduler = PostProcessingScheduler()
+            
+        cfxDirs = {}
+        for dpIndex in range(len(self.sweepDict[designPointColumnName])):
+            cfxDirs[dpIndex] = self.findDesignPointDir(designPointColumnName, dpIndex)[1]
             
-    def readResultFiles(self, designPointColumnName):
+        watcher = DesignPointWatcher(cfxDirs, includeExisting)
+        lastPoll = None
+        lastFinished = time.time()
+        unfinished = []
+        busy = False
+        
+        try:
+            while watcher.pending or busy:
+                if watcher.pending and (lastPoll is None or time.time() - lastPoll >= pollInterval):
+                    lastPoll = time.time()
+                    
+                    for dpIndex, resultsFile in watcher.poll():
+                        lastFinished = time.time()
+                        designPoint = self.findDesignPointDir(designPointColumnName, dpIndex)[0]
+                        print 'Design Point ' + str(dpIndex) + ' has finished solving'
+                        job = self.createPostProcessingJob(dpIndex, designPoint, cfxDirs[dpIndex], resultsFile, persistent=pool is not None)
+                        if pool is not None:
+                            pool.submit(job)
+                        else:
+                            scheduler.submit(job)
+                            
+                    if watcher.pending and idleTimeout is not None and time.time() - lastFinished >= idleTimeout:
+                        #Stop waiting for design points that will not finish
+                        unfinished = sorted(watcher.pending)
+                        print 'No design point finished within ' + str(idleTimeout) + ' s, giving up on Design Points ' + ', '.join([str(dpIndex) for dpIndex in unfinished])
+                        watcher.pending.clear()
+                        
+                busy = scheduler.step()
+                if pool is not None:
+                    busy = busy or pool.isBusy()
+                    
+                if watcher.pending or busy:
+                    time.sleep(min(pollInterval, scheduler.pollInterval))
+                    
+        finally:
+            #Do not leave CFD-Post running if interrupted
+            scheduler.stop()
+            
+        return unfinished
+        
+    def readResultFiles(self, designPointColumnName, resultsDir=None, repository=None, parameterNames=None):
         '''
-        Reads CSV result files into CaseResult objects
+        Reads CSV result files into CaseResult objects. The files are read from
+        resultsDir, or from the working directory if not given. Design points
+        without a result file are left out of sweepCaseResults, so that
+        validateResults flags them.
+        
+        With a ResultsRepository, the outputs of design points that have not
+        been processed are first copied from the repository into the directory
+        being read if it has them (see processResults).
         '''
         #Sweep design points
         for dpIndex in range(len(self.sweepDict[designPointColumnName])):
             #Set the filename for the current design point
             dpFileName = 'results_from_dp' + str(dpIndex) + '.csv'
+            if resultsDir is not None:
+                dpFileName = os.path.join(resultsDir, dpFileName)
+                
+            if repository is not None and not os.path.exists(dpFileName):
+                #Restore next to the file being read rather than to sweepResults.
+                #The output paths are Windows paths, which ntpath splits anywhere.
+                outputFiles = [os.path.join(os.path.dirname(dpFileName), ntpath.basename(outputFile)) for outputFile in self.getDesignPointOutputs(dpIndex)]
+                repository.restore(self.getDesignPointKey(designPointColumnName, dpIndex, parameterNames), outputFiles)
+                
+            if not os.path.exists(dpFileName):
+                print 'No results file found for Design Point ' + str(dpIndex)
+                self.sweepCaseResults.pop(dpIndex, None)
+                continue
+                
+            self.sweepCaseResults[dpIndex] = CaseResult(self.getCaseSetup(dpIndex), dpFileName)
+            
+    def getCaseSetup(self, dpIndex):
+        '''
+        Returns the case setup of a design point, Column Name -> Value
+        '''
+        caseSetup = {}
+        for key in self.sweepDict.keys():
+            caseSetup[key] = self.sweepDict[key][dpIndex]
             
-            #Get the case setup for the design point
-            caseSetup = {}
-            for key in self.sweepDict.keys():
-                caseSetup[key] = self.sweepDict[key][dpIndex]
+        return caseSetup
+            
+    def readMetricFiles(self, designPointColumnName, resultsDir=None):
+        '''
+        Collects the metrics exported for each design point (see MetricsExport)
+        into a MetricsTable stored in sweepMetrics. The files are read from
+        resultsDir, or from the working directory if not given. Design points
+        without a metrics file get NaN values.
+        '''
+        numDesignPoints = len(self.sweepDict[designPointColumnName])
+        self.sweepMetrics = MetricsTable(numDesignPoints)
+        
+        for dpIndex in range(numDesignPoints):
+            dpFileName = 'metrics_dp' + str(dpIndex) + '.csv'
+            if resultsDir is not None:
+                dpFileName = os.path.join(resultsDir, dpFileName)
+                
+            if os.path.exists(dpFileName):
+                self.sweepMetrics.readMetricsFile(dpIndex, dpFileName)
+                
+        return self.sweepMetrics
+        
+    def getPhysicalBounds(self, dpIndex, dataset):
+        '''
+        Returns a tuple (min, max) that the y values of 'dataset' of design
+        point dpIndex must lie within, or None if there are no bounds. By
+        default there are none.
+        '''
+        return None
+        
+    def getInputParameterNames(self):
+        '''
+        Returns the names of the input parameter columns in the sweep (see
+        inputParameterNames)
+        '''
+        if self.inputParameterNames is None:
+            raise ValueError('The input parameters of ' + self.__class__.__name__ + ' are unknown, pass parameterNames or set inputParameterNames')
+            
+        return [key for key in self.inputParameterNames if key in self.sweepDict]
+        
+    def getNormalizedParameters(self, designPointColumnName, parameterNames=None):
+        '''
+        Returns a list with the parameters of each design point scaled to the
+        range 0 to 1. By default the parameters are the numeric input
+        parameters that vary across the sweep, as outputs would make design
+        points with different results look far apart.
+        '''
+        if parameterNames is None:
+            parameterNames = []
+            for key in self.getInputParameterNames():
+                values = self.sweepDict[key]
+                if not [value for value in values if type(value) != float] and min(values) != max(values):
+                    parameterNames.append(key)
+                    
+        coordinates = [[] for value in self.sweepDict[designPointColumnName]]
+        for key in parameterNames:
+            values = self.sweepDict[key]
+            low = min(values)
+            span = (max(values) - low) or 1.
+            
+            for dpIndex in range(len(values)):
+                coordinates[dpIndex].append((values[dpIndex] - low)/span)
+                
+        return coordinates
+        
+    def validateResults(self, designPointColumnName, parameterNames=None, numNeighbours=4, outlierThreshold=5.):
+        '''
+        Checks the CaseResults read by readResultFiles for bad design points and
+        returns a ValidationReport. Each series is checked across the whole
+        sweep for:
+        
+        Missing or empty series and NaN values
+        Sample counts that differ from the rest of the sweep
+        Values outside the bounds given by getPhysicalBounds
+        Means that are outliers compared to the 'numNeighbours' nearest design
+        points in parameter space (see getNormalizedParameters). The distance
+        to the median of the neighbours is scaled by their spread and flagged
+        above 'outlierThreshold'.
+        
+        The flagged design points can be passed to processResults to be
+        processed again.
+        '''
+        report = ValidationReport()
+        numDesignPoints = len(self.sweepDict[designPointColumnName])
+        
+        datasetNames = set()
+        for dpIndex in range(numDesignPoints):
+            if dpIndex in self.sweepCaseResults:
+                datasetNames.update(self.sweepCaseResults[dpIndex].results.keys())
+            else:
+                report.addFlag(dpIndex, '', 'Missing', 'No results were read')
+                
+        #Order the other design points by distance in parameter space once for all series
+        coordinates = self.getNormalizedParameters(designPointColumnName, parameterNames)
+        neighbours = []
+        for dpIndex in range(numDesignPoints):
+            distances = []
+            for otherIndex in range(numDesignPoints):
+                if otherIndex != dpIndex:
+                    distance = sum([(a - b)**2 for a, b in zip(coordinates[dpIndex], coordinates[otherIndex])])
+                    distances.append((distance, otherIndex))
+                    
+            neighbours.append([otherIndex for distance, otherIndex in sorted(distances)])
+            
+        for datasetName in sorted(datasetNames):
+            #Line up the series across the sweep
+            datasets = [None]*numDesignPoints
+            for dpIndex in self.sweepCaseResults.keys():
+                datasets[dpIndex] = self.sweepCaseResults[dpIndex].results.get(datasetName)
+                
+            #The expected sample count is the most common one
+            counts = [len(dataset.y) for dataset in datasets if dataset is not None and dataset.y]
+            if counts:
+                expectedCount = max(set(counts), key=counts.count)
+            
+            means = [None]*numDesignPoints
+            for dpIndex in self.sweepCaseResults.keys():
+                dataset = datasets[dpIndex]
+                if dataset is None or not dataset.y:
+                    report.addFlag(dpIndex, datasetName, 'Empty', 'The series is missing or has no samples')
+                    continue
+                    
+                numNaN = len([value for value in dataset.x + dataset.y if value != value])
+                if numNaN:
+                    report.addFlag(dpIndex, datasetName, 'NaN', str(numNaN) + ' NaN values')
+                    continue
+                    
+                if len(dataset.y) != expectedCount:
+                    report.addFlag(dpIndex, datasetName, 'Sample Count', str(len(dataset.y)) + ' samples, expected ' + str(expectedCount))
+                    
+                bounds = self.getPhysicalBounds(dpIndex, dataset)
+                if bounds is not None:
+                    numOutside = len([value for value in dataset.y if value < bounds[0] or value > bounds[1]])
+                    if numOutside:
+                        report.addFlag(dpIndex, datasetName, 'Bounds', str(numOutside) + ' values outside ' + str(bounds))
+                        
+                means[dpIndex] = sum(dataset.y)/len(dataset.y)
                 
-            self.sweepCaseResults[dpIndex] = CaseResult(caseSetup, dpFileName)
-            
+            #Compare the mean of each design point to those of its neighbours
+            for dpIndex in range(numDesignPoints):
+                if means[dpIndex] is None:
+                    continue
+                    
+                neighbourMeans = [means[otherIndex] for otherIndex in neighbours[dpIndex] if means[otherIndex] is not None][:numNeighbours]
+                if len(neighbourMeans) < 2:
+                    continue
+                    
+                center = median(neighbourMeans)
+                spread = 1.4826*median([abs(value - center) for value in neighbourMeans])
+                
+                #Neighbours that agree exactly should not flag small differences
+                scale = max(spread, 0.01*abs(center), 1e-12)
+                score = abs(means[dpIndex] - center)/scale
+                
+                if score > outlierThreshold:
+                    report.addFlag(dpIndex, datasetName, 'Outlier', 'Mean ' + str(means[dpIndex]) + ' against ' + str(center) + ' for its neighbours')
+                    
+        return report
+        
     def plotCaseResults(self, designPoint, dataset):
         raise NotImplementedError
             
@@ -170,20 +1700,43 @@ class FlapperDesignSweep(CaseSweep):
     we want the range to be fixed for the constant pressure drop cases but scaled
     for the constant Re cases.
     '''
-    def writeSessionFile(self, sessionFileName, dpIndex):
-        #Set the directory to save the results
-        resultsDir = self.rootDir + '\\sweepResults'
+    inputParameterNames = ['P12 - Re', 'P15 - lift', 'P16 - UseRe', 'P17 - Pinlet']
+    
+    def getPhysicalBounds(self, dpIndex, dataset):
+        '''
+        For the constant pressure drop cases, the probed pressures must lie
+        within -Pinlet and 1.1 Pinlet. The constant Re cases have no bounds.
+        '''
+        if dataset.yLabel != 'Pressure' or self.sweepDict['P16 - UseRe'][dpIndex] != 0:
+            return None
+            
+        #The key for the inlet pressure is hard coded!
+        pInlet = self.sweepDict['P17 - Pinlet'][dpIndex]
         
-        #Create a new session file object
-        session = SessionFile([])
+        return (-pInlet, 1.1*pInlet)
+        
+    def getSharedSessionSections(self):
+        sections = []
         
         #Hide model wireframe
-        session.addSection(VisibilityAction('/WIREFRAME:Wireframe', '/VIEW:View 1', 'hide'))
+        sections.append(VisibilityAction('/WIREFRAME:Wireframe', '/VIEW:View 1', 'hide'))
         
         #Orient view
         #NOTE: This is highly dependent on your model. It is best to create this
         #by recording a session in CFD-Post where you orient the model accordingly
-        session.addSection(View('View 1', [-2.69195e-006, 0.000327419, 0.00225109], 555.248, [-3.16153e-005, -0.000739617], [0, 0.707107, 0, 0.707107]))
+        sections.append(View('View 1', [-2.69195e-006, 0.000327419, 0.00225109], 555.248, [-3.16153e-005, -0.000739617], [0, 0.707107, 0, 0.707107]))
+        
+        #Define the expressions of the metrics
+        sections.extend(self.metrics)
+        
+        return sections
+        
+    def getDesignPointSessionSections(self, dpIndex):
+        #Set the directory to save the results
+        resultsDir = self.getResultsDir(dpIndex)
+        
+        #Create a new session file object to collect the sections
+        session = SessionFile([])
         
         #Set the location and filename of the pressure contour
         locToSaveContour = resultsDir + '\\pressure_contour_dp'+ str(dpIndex) + '.png'
@@ -219,8 +1772,9 @@ class FlapperDesignSweep(CaseSweep):
             
             lines.append(line)
             
-        #Create a chart object to plot the data
-        probedData = Chart('Chart' + str(dpIndex), 'X', 'Pressure')
+        #Create a chart object to plot the data. The name is the same for every
+        #design point so a persistent CFD-Post worker redefines a single chart
+        probedData = Chart('Line Probes', 'X', 'Pressure')
         
         #Add series for lines
         for line in lines:
@@ -229,13 +1783,142 @@ class FlapperDesignSweep(CaseSweep):
         #Create an export object
         export = Export(probedData, resultsDir + '\\results_from_dp' + str(dpIndex) + '.csv')
             
-        #Create the session object
+        #Add the sections
         session.addSection(lines)
         session.addSection(probedData)
         session.addSection(export)
         
-        #Write the session file
-        session.writeSessionFile(sessionFileName)
+        #Evaluate the metrics
+        if self.metrics:
+            session.addSection(MetricsExport(self.metrics, resultsDir + '\\metrics_dp' + str(dpIndex) + '.csv'))
+            
+        return session.sections
+        
+class SweepRefiner(object):
+    '''
+    Picks the next design points to solve where they improve the sweep most.
+    
+    'sweep' is a CaseSweep, 'parameterNames' the input parameters to refine
+    over and 'metricValues' the value of the chosen metric for each design
+    point (e.g. a column of sweep.sweepMetrics); design points with a NaN
+    value are ignored. Candidates on a grid over the range of the parameters
+    are ranked by the interpolation error expected there: the local gradient
+    of the metric, estimated from the nearest solved design points, times
+    the distance to the nearest design point. Distances are measured with
+    each parameter scaled to the range 0 to 1. The input parameters that are
+    not refined are taken from the nearest solved design point.
+    '''
+    def __init__(self, sweep, designPointColumnName, parameterNames, metricValues):
+        self.sweep = sweep
+        self.designPointColumnName = designPointColumnName
+        self.parameterNames = parameterNames
+        self.lows = [min(sweep.sweepDict[name]) for name in parameterNames]
+        self.spans = [(max(sweep.sweepDict[name]) - min(sweep.sweepDict[name])) or 1. for name in parameterNames]
+        
+        self.points = []
+        self.values = []
+        self.dpIndices = []
+        for dpIndex in range(len(metricValues)):
+            if metricValues[dpIndex] == metricValues[dpIndex]:
+                self.dpIndices.append(dpIndex)
+                self.points.append(self.normalize([sweep.sweepDict[name][dpIndex] for name in parameterNames]))
+                self.values.append(metricValues[dpIndex])
+                
+    def normalize(self, parameters):
+        return [(parameters[i] - self.lows[i])/self.spans[i] for i in range(len(parameters))]
+        
+    def denormalize(self, coordinates):
+        return [self.lows[i] + coordinates[i]*self.spans[i] for i in range(len(coordinates))]
+        
+    def generateCandidates(self, maxCandidates=5000):
+        '''
+        Returns a grid of about maxCandidates normalized candidate points
+        spanning the range of the parameters
+        '''
+        numParameters = len(self.parameterNames)
+        pointsPerAxis = max(2, int(round(maxCandidates**(1./numParameters))))
+        axis = [i/float(pointsPerAxis - 1) for i in range(pointsPerAxis)]
+        
+        candidates = [[]]
+        for i in range(numParameters):
+            candidates = [candidate + [value] for candidate in candidates for value in axis]
+            
+        return candidates
+        
+    def estimateGradients(self, candidates, numNeighbours=None):
+        '''
+        Returns, for each candidate, the distance to the nearest design point
+        and the largest slope of the metric between its 'numNeighbours' nearest
+        design points (one more than the number of parameters by default)
+        '''
+        if numNeighbours is None:
+            numNeighbours = len(self.parameterNames) + 1
+            
+        #Slopes between design points do not depend on the candidate, so compute them once
+        numPoints = len(self.points)
+        slopes = [[0.]*numPoints for i in range(numPoints)]
+        for i in range(numPoints):
+            for j in range(i + 1, numPoints):
+                distance = sum([(a - b)**2 for a, b in zip(self.points[i], self.points[j])])**0.5
+                if distance > 0:
+                    slopes[i][j] = slopes[j][i] = abs(self.values[i] - self.values[j])/distance
+                    
+        nearestDistances = []
+        gradients = []
+        for candidate in candidates:
+            distances = sorted([(sum([(a - b)**2 for a, b in zip(candidate, point)]), i) for i, point in enumerate(self.points)])
+            nearest = [i for distance, i in distances[:numNeighbours]]
+            
+            nearestDistances.append(distances[0][0]**0.5)
+            gradients.append(max([slopes[i][j] for i in nearest for j in nearest]))
+            
+        return nearestDistances, gradients
+        
+    def selectDesignPoints(self, numPoints, maxCandidates=5000):
+        '''
+        Returns the 'numPoints' best new design points as dictionaries of
+        Parameter Name -> Value. Each pick counts as a design point when
+        ranking the rest, so the picks spread out.
+        '''
+        candidates = self.generateCandidates(maxCandidates)
+        nearestDistances, gradients = self.estimateGradients(candidates)
+        
+        newDesignPoints = []
+        for n in range(numPoints):
+            scores = [gradients[i]*nearestDistances[i] for i in range(len(candidates))]
+            best = max(range(len(candidates)), key=scores.__getitem__)
+            if scores[best] <= 0:
+                #The metric is flat everywhere or every candidate is solved
+                break
+                
+            pick = candidates[best]
+            newDesignPoint = dict(zip(self.parameterNames, self.denormalize(pick)))
+            
+            #Fill the other inputs from the nearest solved design point
+            distances = [sum([(a - b)**2 for a, b in zip(point, pick)]) for point in self.points]
+            nearest = self.dpIndices[min(range(len(distances)), key=distances.__getitem__)]
+            for name in self.sweep.getInputParameterNames():
+                if name not in newDesignPoint:
+                    newDesignPoint[name] = self.sweep.sweepDict[name][nearest]
+                    
+            newDesignPoints.append(newDesignPoint)
+            
+            for i in range(len(candidates)):
+                distance = sum([(a - b)**2 for a, b in zip(candidates[i], pick)])**0.5
+                nearestDistances[i] = min(nearestDistances[i], distance)
+                
+        return newDesignPoints
+        
+    def writeRefinedSweep(self, sweepDefinitionFile, numPoints, maxCandidates=5000, includeExisting=True):
+        '''
+        Picks numPoints new design points and writes them to a sweep
+        definition file (see CaseSweep.writeSweepDefFile). Returns the new
+        design points.
+        '''
+        newDesignPoints = self.selectDesignPoints(numPoints, maxCandidates)
+        self.sweep.writeSweepDefFile(sweepDefinitionFile, self.designPointColumnName, newDesignPoints, includeExisting)
+        
+        return newDesignPoints
         
 ################################################################################
 
@@ -246,13 +1929,15 @@ class FlapperDesignSweep(CaseSweep):
 class CaseResult(object):
     '''
     Object with special methods for collecting and viewing results along a line
-    exported from Ansys CFD-Post
+    exported from Ansys CFD-Post. If caseResultsFile is None, the results are
+    left empty to be filled in by the caller.
     '''
     def __init__(self, caseSetup, caseResultsFile):
         self.caseSetup = caseSetup
         self.results = {}
         
-        self.readCaseResults(caseResultsFile)
+        if caseResultsFile is not None:
+            self.readCaseResults(caseResultsFile)
         
     def readCaseResults(self, caseResultsFile):
         caseResults = []
@@ -289,6 +1974,89 @@ class CaseResult(object):
                     i += 1
                      
         
+class MetricsTable(object):
+    '''
+    Table of the scalar metrics of a sweep. Each metric is a column stored as
+    an array of doubles indexed by design point, NaN where there is no value.
+    '''
+    def __init__(self, numDesignPoints):
+        self.numDesignPoints = numDesignPoints
+        self.names = []
+        self.units = {}
+        self.columns = {}
+        
+    def setValue(self, name, dpIndex, value, units=''):
+        if name not in self.columns:
+            self.names.append(name)
+            self.units[name] = units
+            self.columns[name] = array.array('d', [float('nan')]*self.numDesignPoints)
+            
+        self.columns[name][dpIndex] = value
+        
+    def getColumn(self, name):
+        '''
+        Returns the values of metric 'name' for every design point
+        '''
+        return self.columns[name]
+        
+    def readMetricsFile(self, dpIndex, metricsFileName):
+        '''
+        Reads the metrics of design point dpIndex written by a MetricsExport
+        '''
+        with open(metricsFileName, 'rb') as csvFile:
+            metricsData = csv.reader(csvFile, delimiter=',')
+            metricsData.next()  #Skip the header row
+            
+            for row in metricsData:
+                try:
+                    value = float(row[1])
+                except (ValueError, IndexError):
+                    #The expression could not be evaluated
+                    continue
+                    
+                self.setValue(row[0], dpIndex, value, row[2].strip() if len(row) > 2 else '')
+                
+    def writeTable(self, tableFileName):
+        '''
+        Writes the table to a CSV file with a header row, a units row and a row
+        per design point, like the sweep definition files
+        '''
+        with open(tableFileName, 'wb') as csvFile:
+            tableWriter = csv.writer(csvFile, delimiter=',')
+            tableWriter.writerow(['Design Point Index'] + self.names)
+            tableWriter.writerow([''] + [self.units[name] for name in self.names])
+            
+            for dpIndex in range(self.numDesignPoints):
+                tableWriter.writerow([dpIndex] + [repr(self.columns[name][dpIndex]) for name in self.names])
+                
+class ValidationReport(object):
+    '''
+    Collects the problems found by CaseSweep.validateResults. Each flag is a
+    tuple of (dpIndex, datasetName, check, message)
+    '''
+    def __init__(self):
+        self.flags = []
+        
+    def addFlag(self, dpIndex, datasetName, check, message):
+        self.flags.append((dpIndex, datasetName, check, message))
+        
+    def getFlaggedDesignPoints(self):
+        '''
+        Returns the sorted list of design points with at least one flag
+        '''
+        return sorted(set([flag[0] for flag in self.flags]))
+        
+    def writeReport(self, reportFileName):
+        '''
+        Writes the flags to a CSV file
+        '''
+        with open(reportFileName, 'wb') as csvFile:
+            reportWriter = csv.writer(csvFile, delimiter=',')
+            reportWriter.writerow(['Design Point Index', 'Dataset', 'Check', 'Message'])
+            
+            for flag in sorted(self.flags):
+                reportWriter.writerow(flag)
+                
 class Dataset(object):
     '''
     Defines a dataset object with X and Y labels and data
@@ -312,6 +2080,440 @@ class Dataset(object):
 
 ################################################################################
 
+#Objects for serving sweep results to other processes
+
+################################################################################
+
+def receiveBytes(sock, numBytes):
+    '''
+    Receives exactly numBytes from sock. Returns None if the connection was
+    closed before any byte was received.
+    '''
+    chunks = []
+    numReceived = 0
+    while numReceived < numBytes:
+        chunk = sock.recv(min(numBytes - numReceived, 1048576))
+        if not chunk:
+            if numReceived == 0:
+                return None
+            raise IOError('Connection closed in the middle of a message')
+            
+        chunks.append(chunk)
+        numReceived += len(chunk)
+        
+    return ''.join(chunks)
+    
+def sendMessage(sock, header, arrays=[]):
+    '''
+    Sends a message made of a JSON header and arrays of doubles. The arrays
+    are sent as raw bytes after the header rather than as text.
+    '''
+    header = dict(header)
+    header['arrays'] = [len(values) for values in arrays]
+    header['byteorder'] = sys.byteorder
+    
+    headerText = json.dumps(header)
+    payload = ''.join([values.tostring() for values in arrays])
+    
+    sock.sendall(struct.pack('!II', len(headerText), len(payload)) + headerText + payload)
+    
+def receiveMessage(sock):
+    '''
+    Receives a message sent by sendMessage. Returns the header and the list of
+    arrays, or (None, None) if the connection was closed.
+    '''
+    lengths = receiveBytes(sock, 8)
+    if lengths is None:
+        return None, None
+        
+    headerLength, payloadLength = struct.unpack('!II', lengths)
+    header = json.loads(receiveBytes(sock, headerLength))
+    payload = receiveBytes(sock, payloadLength) if payloadLength else ''
+    
+    arrays = []
+    offset = 0
+    for length in header['arrays']:
+        values = array.array('d')
+        values.fromstring(payload[offset:offset + values.itemsize*length])
+        if header['byteorder'] != sys.byteorder:
+            values.byteswap()
+            
+        arrays.append(values)
+        offset += values.itemsize*length
+        
+    return header, arrays
+    
+class SweepResultsRequestHandler(SocketServer.BaseRequestHandler):
+    '''
+    Answers the queries of one client connection of a SweepResultsServer
+    '''
+    def handle(self):
+        while True:
+            request, arrays = receiveMessage(self.request)
+            if request is None:
+                return
+                
+            try:
+                header, arrays = self.server.service.answer(request)
+            except Exception, e:
+                header, arrays = {'error': e.__class__.__name__ + ': ' + str(e)}, []
+                
+            sendMessage(self.request, header, arrays)
+            
+class SweepResultsServer(object):
+    '''
+    Keeps the results of a sweep in memory and answers queries for them from
+    other processes (see SweepResultsClient), so that analysis scripts do not
+    each re-read the sweep definition and re-parse every result file.
+    
+    'sweep' is a CaseSweep whose result and metrics files are in resultsDir.
+    The server listens on 'address', a (host, port) tuple, or the path of a
+    Unix socket where those are available. Result and metrics files that are
+    new or changed are read again at most every 'reloadInterval' seconds,
+    when a query comes in.
+    '''
+    def __init__(self, sweep, designPointColumnName, resultsDir, address=('localhost', 8642), reloadInterval=5.):
+        self.sweep = sweep
+        self.designPointColumnName = designPointColumnName
+        self.resultsDir = resultsDir
+        self.reloadInterval = reloadInterval
+        self.fileMtimes = {}
+        self.lastReload = None
+        self.lock = threading.Lock()
+        
+        self.reload()
+        
+        if type(address) == str:
+            serverClass = SocketServer.ThreadingUnixStreamServer
+            self.removeStaleSocket(address)
+        else:
+            serverClass = SocketServer.ThreadingTCPServer
+            
+        self.address = address
+        self.server = serverClass(address, SweepResultsRequestHandler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.service = self
+        self.server.server_bind()
+        self.server.server_activate()
+        
+    def serveForever(self):
+        '''
+        Answers queries until close() is called
+        '''
+        self.server.serve_forever()
+        
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        
+        if type(self.address) == str and os.path.exists(self.address):
+            os.remove(self.address)
+            
+    def removeStaleSocket(self, socketFile):
+        '''
+        Removes the socket file left behind by a server that did not close,
+        which would otherwise stop this one from binding. A socket file a
+        running server answers on is left alone.
+        '''
+        if not os.path.exists(socketFile):
+            return
+            
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socketFile)
+        except socket.error:
+            os.remove(socketFile)
+        finally:
+            sock.close()
+            
+    def hasChanged(self, fileName):
+        '''
+        Returns True if fileName exists and has changed since it was last read
+        '''
+        try:
+            mtime = os.stat(fileName).st_mtime
+        except OSError:
+            return False
+            
+        if self.fileMtimes.get(fileName) == mtime:
+            return False
+            
+        self.fileMtimes[fileName] = mtime
+        return True
+        
+    def reload(self):
+        '''
+        Reads the result and metrics files that are new or have changed since
+        the last reload
+        '''
+        self.lastReload = time.time()
+        metricsChanged = False
+        
+        for dpIndex in range(len(self.sweep.sweepDict[self.designPointColumnName])):
+            dpFileName = os.path.join(self.resultsDir, 'results_from_dp' + str(dpIndex) + '.csv')
+            if self.hasChanged(dpFileName):
+                self.sweep.sweepCaseResults[dpIndex] = CaseResult(self.sweep.getCaseSetup(dpIndex), dpFileName)
+                
+            if self.hasChanged(os.path.join(self.resultsDir, 'metrics_dp' + str(dpIndex) + '.csv')):
+                metricsChanged = True
+                
+        if metricsChanged:
+            self.sweep.readMetricFiles(self.designPointColumnName, self.resultsDir)
+            
+    def getDatasets(self, datasetName, dpIndices):
+        return [self.sweep.sweepCaseResults[dpIndex].results.get(datasetName) if dpIndex in self.sweep.sweepCaseResults else None for dpIndex in dpIndices]
+        
+    def answer(self, request):
+        '''
+        Returns the header and arrays answering a query. The queries are:
+        
+        sweep: the sweep definition
+        caseResult (dpIndex): all series of a design point
+        series (datasetName, dpIndices): one series of several design points
+        parameters (names, dpIndices): values of sweep parameters
+        aggregate (datasetName, function, dpIndices): the mean, min, max or
+        sum of a series for each design point, NaN where it is missing
+        metrics: the MetricsTable of the sweep
+        '''
+        with self.lock:
+            if time.time() - self.lastReload >= self.reloadInterval:
+                self.reload()
+                
+            query = request['query']
+            dpIndices = request.get('dpIndices')
+            if dpIndices is None:
+                dpIndices = range(len(self.sweep.sweepDict[self.designPointColumnName]))
+                
+            if query == 'sweep':
+                return {'sweepFile': self.sweep.sweepFile, 'rootDir': self.sweep.rootDir, 'modelName': self.sweep.modelName, 'sweepDict': self.sweep.sweepDict, 'sweepHeaders': self.sweep.sweepHeaders, 'sweepUnits': self.sweep.sweepUnits, 'inputParameterNames': self.sweep.inputParameterNames, 'caseResults': sorted(self.sweep.sweepCaseResults.keys())}, []
+                
+            elif query == 'caseResult':
+                caseResult = self.sweep.sweepCaseResults[request['dpIndex']]
+                names = sorted(caseResult.results.keys())
+                datasets = [caseResult.results[name] for name in names]
+                
+            elif query == 'series':
+                datasets = self.getDatasets(request['datasetName'], dpIndices)
+                names = [request['datasetName']]*len(datasets)
+                
+            elif query == 'parameters':
+                return {'parameters': dict([(name, [self.sweep.sweepDict[name][dpIndex] for dpIndex in dpIndices]) for name in request['names']])}, []
+                
+            elif query == 'aggregate':
+                functions = {'mean': lambda values: sum(values)/len(values), 'min': min, 'max': max, 'sum': sum}
+                if request['function'] not in functions:
+                    raise ValueError('The aggregate function must be one of ' + str(sorted(functions.keys())))
+                    
+                function = functions[request['function']]
+                values = array.array('d', [function(dataset.y) if dataset is not None and dataset.y else float('nan') for dataset in self.getDatasets(request['datasetName'], dpIndices)])
+                return {}, [values]
+                
+            elif query == 'metrics':
+                metrics = self.sweep.sweepMetrics
+                if metrics is None:
+                    return {'names': [], 'units': {}, 'numDesignPoints': len(dpIndices)}, []
+                    
+                return {'names': metrics.names, 'units': metrics.units, 'numDesignPoints': metrics.numDesignPoints}, [metrics.getColumn(name) for name in metrics.names]
+                
+            else:
+                raise ValueError('Unknown query "' + str(query) + '"')
+                
+            #Send the x and y values of each series as arrays
+            labels = []
+            arrays = []
+            for dataset in datasets:
+                if dataset is None:
+                    labels.append(None)
+                else:
+                    labels.append([dataset.xLabel, dataset.xUnit, dataset.yLabel, dataset.yUnit])
+                    arrays.extend([array.array('d', dataset.x), array.array('d', dataset.y)])
+                    
+            return {'names': names, 'labels': labels}, arrays
+            
+class RemoteCaseResults(object):
+    '''
+    Dictionary-like view of the CaseResults held by a SweepResultsServer,
+    dpIndex -> CaseResult. Each CaseResult is fetched on first access and
+    then cached.
+    '''
+    def __init__(self, client, dpIndices):
+        self.client = client
+        self.dpIndices = dpIndices
+        self.cache = {}
+        
+    def __getitem__(self, dpIndex):
+        if dpIndex not in self.cache:
+            if dpIndex not in self.dpIndices:
+                raise KeyError(dpIndex)
+                
+            header, arrays = self.client.query({'query': 'caseResult', 'dpIndex': dpIndex})
+            caseResult = CaseResult(self.client.getCaseSetup(dpIndex), None)
+            caseResult.results = dict(self.client.makeDatasets(header, arrays))
+            self.cache[dpIndex] = caseResult
+            
+        return self.cache[dpIndex]
+        
+    def __contains__(self, dpIndex):
+        return dpIndex in self.dpIndices
+        
+    def __len__(self):
+        return len(self.dpIndices)
+        
+    def __iter__(self):
+        return iter(self.dpIndices)
+        
+    def keys(self):
+        return list(self.dpIndices)
+        
+    def values(self):
+        return [self[dpIndex] for dpIndex in self.dpIndices]
+        
+    def items(self):
+        return [(dpIndex, self[dpIndex]) for dpIndex in self.dpIndices]
+        
+class SweepResultsClient(object):
+    '''
+    Client of a SweepResultsServer listening on 'address'. It wraps a sweep of
+    class 'sweepClass' (e.g. FlapperDesignSweep, the class the server's sweep
+    was made with) whose definition and results come from the server instead
+    of files: sweepDict, sweepHeaders and sweepUnits are fetched on creation
+    and sweepCaseResults fetches each CaseResult as it is used. Any other
+    attribute is looked up on the sweep, so methods such as validateResults
+    work as usual, including the overrides of sweepClass. readResultFiles
+    picks up results that are new on the server and readMetricFiles returns
+    its MetricsTable. getSeries, getParameters and getAggregate query across
+    design points directly.
+    '''
+    def __init__(self, address=('localhost', 8642), sweepClass=CaseSweep):
+        if type(address) == str:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            
+        self.sock.connect(address)
+        self.lock = threading.Lock()
+        
+        #Create the sweep without reading a sweep definition file
+        self.sweep = sweepClass.__new__(sweepClass)
+        self.sweep.sweepMetrics = None
+        self.sweep.metrics = []
+        self.sweep.localResultsDirs = {}
+        
+        self.readResultFiles()
+        
+    def __getattr__(self, name):
+        #Only called for attributes the client does not have itself
+        if name == 'sweep':
+            raise AttributeError(name)
+            
+        return getattr(self.sweep, name)
+        
+    def close(self):
+        self.sock.close()
+        
+    def query(self, request):
+        '''
+        Sends a query to the server and returns the header and arrays of the
+        answer
+        '''
+        with self.lock:
+            sendMessage(self.sock, request)
+            header, arrays = receiveMessage(self.sock)
+            
+        if header is None:
+            raise IOError('The server closed the connection')
+            
+        if 'error' in header:
+            raise ValueError(header['error'])
+            
+        return header, arrays
+        
+    def readResultFiles(self, designPointColumnName=None):
+        '''
+        Fetches the sweep definition and the design points with results from
+        the server, dropping any cached CaseResults
+        '''
+        header, arrays = self.query({'query': 'sweep'})
+        
+        self.sweep.sweepFile = header['sweepFile']
+        self.sweep.rootDir = header['rootDir']
+        self.sweep.modelName = header['modelName']
+        self.sweep.sweepDict = header['sweepDict']
+        self.sweep.sweepUnits = header['sweepUnits']
+        self.sweep.sweepHeaders = {}
+        for col, name in header['sweepHeaders'].items():
+            #JSON turns the column indices into strings
+            self.sweep.sweepHeaders[int(col)] = name
+            
+        if header['inputParameterNames'] is not None:
+            self.sweep.inputParameterNames = header['inputParameterNames']
+            
+        self.sweep.sweepCaseResults = RemoteCaseResults(self, header['caseResults'])
+        
+    def readMetricFiles(self, designPointColumnName=None, resultsDir=None):
+        '''
+        Fetches the MetricsTable of the sweep from the server
+        '''
+        header, arrays = self.query({'query': 'metrics'})
+        
+        self.sweep.sweepMetrics = MetricsTable(header['numDesignPoints'])
+        for name, values in zip(header['names'], arrays):
+            self.sweep.sweepMetrics.names.append(name)
+            self.sweep.sweepMetrics.units[name] = header['units'][name]
+            self.sweep.sweepMetrics.columns[name] = values
+            
+        return self.sweep.sweepMetrics
+        
+    def makeDatasets(self, header, arrays):
+        '''
+        Returns the list of (name, Dataset) sent by the server. Missing series
+        are None.
+        '''
+        datasets = []
+        i = 0
+        for name, labels in zip(header['names'], header['labels']):
+            if labels is None:
+                datasets.append((name, None))
+                continue
+                
+            dataset = Dataset(name, labels[0], labels[1], labels[2], labels[3])
+            dataset.x = arrays[i]
+            dataset.y = arrays[i + 1]
+            datasets.append((name, dataset))
+            i += 2
+            
+        return datasets
+        
+    def getSeries(self, datasetName, dpIndices=None):
+        '''
+        Returns the list of Datasets named datasetName for the design points in
+        dpIndices (all by default), None where missing
+        '''
+        header, arrays = self.query({'query': 'series', 'datasetName': datasetName, 'dpIndices': dpIndices})
+        
+        return [dataset for name, dataset in self.makeDatasets(header, arrays)]
+        
+    def getParameters(self, names, dpIndices=None):
+        '''
+        Returns a dictionary of Column Name -> List of Values for the design
+        points in dpIndices (all by default)
+        '''
+        header, arrays = self.query({'query': 'parameters', 'names': names, 'dpIndices': dpIndices})
+        
+        return header['parameters']
+        
+    def getAggregate(self, datasetName, function='mean', dpIndices=None):
+        '''
+        Returns an array of the mean, min, max or sum of series datasetName for
+        each design point in dpIndices (all by default), NaN where missing
+        '''
+        header, arrays = self.query({'query': 'aggregate', 'datasetName': datasetName, 'function': function, 'dpIndices': dpIndices})
+        
+        return arrays[0]
+        
+################################################################################
+
 #Objects for creating Ansys CFD-Post session files
 
 ################################################################################
@@ -719,6 +2921,12 @@ class Export(object):
         self.loc = exportLocation
         self.overwrite = overwrite
         
+    def getOutputFiles(self):
+        '''
+        Returns the list of files written by the export
+        '''
+        return [self.loc]
+        
     def getDefinition(self):
         '''
         Returns the export definition as a list of lines (Without EOL markers)
@@ -732,6 +2940,62 @@ class Export(object):
         
         return exportDef
         
+class Expression(object):
+    '''
+    Defines a CFD-Post (CEL) expression named 'name' in the session file, such
+    as Expression('inletPressure', 'areaAve(Pressure)@inlet')
+    '''
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+        
+    def getDefinition(self):
+        '''
+        Returns the expression definition as a list of lines (Without EOL markers)
+        '''
+        expressionDef = [ 'LIBRARY:',
+        '  CEL:',
+        '    EXPRESSIONS:',
+        '      ' + self.name + ' = ' + self.definition,
+        '    END',
+        '  END',
+        'END']
+        
+        return expressionDef
+        
+class MetricsExport(object):
+    '''
+    Evaluates the Expression objects in 'expressions' in CFD-Post and writes
+    their values to a small CSV table at 'fileName' with the columns Name,
+    Value and Units. This avoids exporting dense chart data only to reduce it
+    to a few numbers afterwards.
+    '''
+    def __init__(self, expressions, fileName):
+        self.expressions = expressions
+        self.fileName = fileName
+        
+    def getOutputFiles(self):
+        '''
+        Returns the list of files written by the export
+        '''
+        return [self.fileName]
+        
+    def getDefinition(self):
+        '''
+        Returns the export as a list of (Perl) lines (Without EOL markers)
+        '''
+        #Perl accepts forward slashes in Windows paths and they need no escaping
+        metricsDef = ["! open(METRICS, '>" + self.fileName.replace('\\', '/') + "');",
+        '! print METRICS "Name,Value,Units\\n";']
+        
+        for expression in self.expressions:
+            metricsDef.extend(["! ($value, $units) = evaluate('" + expression.name + "');",
+            '! print METRICS "' + expression.name + ',$value,$units\\n";'])
+            
+        metricsDef.append('! close(METRICS);')
+        
+        return metricsDef
+        
 class Hardcopy(object):
     '''
     Defines a hardcopy object which is responsible for saving the viewport to an
@@ -744,6 +3008,12 @@ class Hardcopy(object):
         self.fileName = fileName
         self.imageSize = imageSize
         
+    def getOutputFiles(self):
+        '''
+        Returns the list of files written by the hardcopy
+        '''
+        return [self.fileName]
+        
     def getDefinition(self):
         hardcopyDef = [ 'HARDCOPY:',
         '  Antialiasing = On',
@@ -785,6 +3055,22 @@ class View(object):
         
         return viewDef
 
+class Load(object):
+    '''
+    Defines a load action which opens the results file 'fileName' in CFD-Post,
+    replacing the case that is loaded
+    '''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        
+    def getDefinition(self):
+        '''
+        Returns the load action as a list of lines (Without EOL markers)
+        '''
+        loadDef = ['>load filename=' + self.fileName + ', force_reload=true']
+        
+        return loadDef
+        
 class VisibilityAction(object):
     '''
     Defines a visibility action for the CFD-Post viewport. 'graphicsObject' must